@@ -1,22 +1,34 @@
 import os
 import logging
-from typing import Dict, List, Optional
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+from typing import Awaitable, Callable, Dict, Final, Optional, Tuple
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.types import ErrorEvent, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
+import orjson
 import asyncio
-import traceback
-import uuid
+import base64
+import functools
+import gzip
+import hashlib
+import secrets
+import signal
+import string
+from collections import OrderedDict
+from dataclasses import dataclass, field
 import time
 from datetime import datetime
 
 # إعداد تسجيل الأخطاء المفصل
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),  # يُفضل WARNING في بيئة الإنتاج
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -27,6 +39,21 @@ CHANNEL_ID = os.getenv('CHANNEL_ID')  # معرف القناة الرقمي (مث
 CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME')  # اسم القناة بدون @ (مثل: my_channel)
 DEVELOPER_USERNAME = os.getenv('DEVELOPER_USERNAME')  # اسم المطور بدون @
 PORT = int(os.getenv('PORT', 8080))  # منفذ الخادم الافتراضي لـ Render
+REDIS_URL = os.getenv('REDIS_URL')  # اختياري: تخزين بيانات المحادثة في Redis (مثل: redis://localhost:6379/0)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 256))  # الحد الأقصى للتحديثات المعالجة بالتوازي
+API_CONCURRENCY = int(os.getenv('API_CONCURRENCY', 50))  # الحد الأقصى لطلبات Telegram API المتزامنة
+API_RETRY_ATTEMPTS = 3       # عدد محاولات إعادة الطلب بعد RetryAfter
+DEBUG_CALLBACKS = os.getenv('DEBUG_CALLBACKS') == '1'  # تفعيل تشخيص الاستدعاءات
+PUBLIC_URL = os.getenv('PUBLIC_URL')  # اختياري: الرابط العام للخادم لتفعيل Webhook (مثل: https://xobot.onrender.com)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)  # سر مسار Webhook وترويسة التحقق
+WEBHOOK_PATH = f'/webhook/{WEBHOOK_SECRET}'
+# أنواع التحديثات المستخدمة فقط (chat_member لتحديث ذاكرة الاشتراك)
+ALLOWED_UPDATES: Final = ['message', 'callback_query', 'inline_query', 'chat_member']
+EDIT_COALESCE_WINDOW = 0.05  # نافذة دمج تعديلات نفس الرسالة بالثواني
+GAME_TTL = 3600              # حذف الألعاب غير النشطة بعد ساعة
+MAX_GAMES = 50000            # الحد الأقصى للألعاب المخزنة في الذاكرة
+GAME_GC_INTERVAL = 300       # الفاصل بين دورات تنظيف الألعاب بالثواني
+STATS_INTERVAL = 10          # الفاصل بين تحديثات إحصائيات لوحة المراقبة بالثواني
 
 # التحقق من وجود المتغيرات المطلوبة
 if not BOT_TOKEN:
@@ -38,54 +65,189 @@ if not CHANNEL_USERNAME:
 if not DEVELOPER_USERNAME:
     raise ValueError("يجب تعيين DEVELOPER_USERNAME في متغيرات البيئة")
 
-# إنشاء كائنات البوت والموزع
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+class TunedAiohttpSession(AiohttpSession):
+    """جلسة aiohttp بموصل TCP مضبوط لإعادة استخدام الاتصالات مع Telegram"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(
+            limit=200,
+            limit_per_host=100,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True
+        )
 
-# حالات المحادثة
-class XOStates(StatesGroup):
-    waiting_subscription = State()
-    main_menu = State()
-    in_game = State()
+# إنشاء كائنات البوت والموزع (مع orjson لترميز طلبات Telegram)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=TunedAiohttpSession(
+        json_loads=orjson.loads,
+        json_dumps=lambda value: orjson.dumps(value).decode()
+    )
+)
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+    storage = RedisStorage.from_url(
+        REDIS_URL,
+        connection_kwargs={'max_connections': 64},
+        key_builder=DefaultKeyBuilder(with_bot_id=True)
+    )
+else:
+    storage = MemoryStorage()
+dp = Dispatcher(storage=storage)
+
+# بيانات أزرار اللعبة (تُحلل مرة واحدة عبر المرشح بدلاً من تقسيم النص في كل معالج)
+class JoinCB(CallbackData, prefix="j"):
+    game_id: str
+
+# معرف زر التحدي الجديد الثابت؛ يُحدد معرف اللعبة الفعلي عند أول نقرة
+NEW_GAME_ID: Final = "new"
+
+class MoveCB(CallbackData, prefix="m"):
+    game_id: str
+    pos: int
+
+class ResetCB(CallbackData, prefix="r"):
+    game_id: str
+
+class DeleteCB(CallbackData, prefix="d"):
+    game_id: str
+
+@dataclass(slots=True)
+class GameState:
+    """حالة لعبة XO واحدة"""
+    player1_id: int                         # اللاعب الأول (X)
+    player1_username: str
+    player2_id: Optional[int] = None        # في انتظار اللاعب الثاني
+    player2_username: Optional[str] = None
+    board: bytearray = field(default_factory=lambda: bytearray(9))
+    p1_mask: int = 0
+    p2_mask: int = 0
+    current_player: str = 'X'
+    game_over: bool = False
+    winner: Optional[str] = None
+    waiting_for_second_player: bool = True
+    player1_wins: int = 0                   # نقاط اللاعب الأول
+    player2_wins: int = 0                   # نقاط اللاعب الثاني
+    last_activity: float = field(default_factory=time.monotonic)
+    keyboard: Optional[InlineKeyboardMarkup] = None  # لوحة اللعبة، تُحدث خاناتها في مكانها
+    header: Optional[str] = None            # سطور النقاط والأدوار، تُمسح عند تغير اللاعبين أو النقاط
+    owner_id: int = 0                       # مالك اللعبة في games (يُعين عند التسجيل)
 
 # تخزين بيانات الألعاب في الذاكرة
 # هيكل: {user_id: {game_id: game_data}}
-games: Dict[int, Dict[str, Dict]] = {}
+games: Dict[int, Dict[str, GameState]] = {}
+
+# فهرس مباشر للألعاب حسب المعرف لتسريع البحث، مرتب من الأقدم نشاطاً إلى الأحدث
+# هيكل: {game_id: game_data} (المالك محفوظ في game_data.owner_id)
+GAME_INDEX: "OrderedDict[str, GameState]" = OrderedDict()
+
+# رموز الخانات: الشبكة مخزنة كـ bytearray(9) حيث 0 = فارغ، 1 = اللاعب الأول، 2 = اللاعب الثاني
+EMPTY_CELL = "⬜"
+X_SYMBOL = "❌"
+O_SYMBOL = "⭕"
+_CELL_TEXT = (EMPTY_CELL, X_SYMBOL, O_SYMBOL)
+
+# أقنعة خطوط الفوز المحتملة (البت رقم pos يمثل الخانة pos)
+_WIN_MASKS = (
+    0b000000111, 0b000111000, 0b111000000,  # الصفوف
+    0b001001001, 0b010010010, 0b100100100,  # الأعمدة
+    0b100010001, 0b001010100                # الأقطار
+)
+FULL_BOARD_MASK = 0x1FF
+
+# بصمة آخر محتوى أُرسل لكل رسالة لتجنب التعديلات المكررة
+# هيكل: {inline_message_id أو (chat_id, message_id): hash}
+_LAST_EDIT_HASH: "OrderedDict[object, int]" = OrderedDict()
+LAST_EDIT_CACHE_SIZE = 10000
+
+# معرفات الاستدعاءات المعالجة مؤخراً لتجاهل التكرار
+# هيكل: {callback_id: وقت_الاستلام}
+_RECENT_CALLBACKS: "OrderedDict[str, float]" = OrderedDict()
+RECENT_CALLBACK_TTL = 60
+
+# ذاكرة مؤقتة لنتائج التحقق من الاشتراك
+# هيكل: {user_id: (وقت_التخزين, مشترك؟)}
+SUB_CACHE: Dict[int, Tuple[float, bool]] = {}
+SUB_CACHE_TTL = 300          # مدة صلاحية النتيجة الإيجابية بالثواني
+SUB_CACHE_NEGATIVE_TTL = 5   # مدة قصيرة للنتيجة السلبية حتى لا يُحجب المشترك الجديد
+SUBSCRIBED_STATUSES = {'member', 'administrator', 'creator'}
 
 # === دوال اكتشاف الأخطاء ===
 
 def debug_callback_data(callback: types.CallbackQuery, function_name: str):
-    """طباعة معلومات مفصلة عن الاستدعاء لأغراض التشخيص"""
-    logger.info(f"=== تشخيص {function_name} ===")
-    logger.info(f"Callback ID: {callback.id}")
-    logger.info(f"Callback Data: {callback.data}")
-    logger.info(f"User ID: {callback.from_user.id}")
-    logger.info(f"Username: {callback.from_user.username}")
-    logger.info(f"First Name: {callback.from_user.first_name}")
+    """طباعة معلومات مختصرة عن الاستدعاء لأغراض التشخيص"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
 
-    if callback.message:
-        logger.info(f"Message ID: {callback.message.message_id}")
-        logger.info(f"Chat ID: {callback.message.chat.id}")
-        logger.info(f"Chat Type: {callback.message.chat.type}")
-        if hasattr(callback.message.chat, 'title'):
-            logger.info(f"Chat Title: {callback.message.chat.title}")
-    else:
-        logger.error("❌ callback.message is None!")
+    logger.debug(
+        "تشخيص %s: id=%s data=%s uid=%s chat=%s msg=%s inline=%s",
+        function_name,
+        callback.id,
+        callback.data,
+        callback.from_user.id,
+        callback.message.chat.id if callback.message else None,
+        callback.message.message_id if callback.message else None,
+        callback.inline_message_id
+    )
 
-    if callback.inline_message_id:
-        logger.info(f"Inline Message ID: {callback.inline_message_id}")
+def is_duplicate_callback(callback_id: str) -> bool:
+    """التحقق مما إذا كان الاستدعاء قد عولج خلال المدة الأخيرة"""
+    now = time.monotonic()
+    while _RECENT_CALLBACKS:
+        oldest_id, seen_at = next(iter(_RECENT_CALLBACKS.items()))
+        if now - seen_at < RECENT_CALLBACK_TTL:
+            break
+        _RECENT_CALLBACKS.popitem(last=False)
+
+    if callback_id in _RECENT_CALLBACKS:
+        return True
+
+    _RECENT_CALLBACKS[callback_id] = now
+    return False
+
+def is_not_modified_error(error: Exception) -> bool:
+    """هل الخطأ هو رفض Telegram لتعديل لم يغير المحتوى (حالة روتينية عند النقرات المتزامنة)"""
+    return isinstance(error, TelegramBadRequest) and 'message is not modified' in str(error)
+
+# دلو رموز لتحديد معدل تسجيل الأخطاء أثناء موجات الأعطال
+ERROR_LOG_RATE = 10  # الحد الأقصى لسجلات الأخطاء في الثانية (وحجم الدفعة)
+_error_log_bucket = {'tokens': float(ERROR_LOG_RATE), 'at': 0.0, 'suppressed': 0}
+
+def log_error(message: str, error: Exception):
+    """تسجيل الخطأ بسطر واحد، مع التتبع الكامل فقط عند مستوى DEBUG وبمعدل محدود"""
+    now = time.monotonic()
+    bucket = _error_log_bucket
+    bucket['tokens'] = min(ERROR_LOG_RATE, bucket['tokens'] + (now - bucket['at']) * ERROR_LOG_RATE)
+    bucket['at'] = now
+    if bucket['tokens'] < 1:
+        bucket['suppressed'] += 1
+        return
+    bucket['tokens'] -= 1
 
-    logger.info(f"=== نهاية تشخيص {function_name} ===")
+    if bucket['suppressed']:
+        logger.warning("تم تجاهل %s سجل خطأ لتجاوز الحد", bucket['suppressed'])
+        bucket['suppressed'] = 0
+    logger.error("%s: %s: %s", message, type(error).__name__, error, exc_info=logger.isEnabledFor(logging.DEBUG))
 
 def safe_callback_handler(func):
     """مُزخرف لالتقاط الأخطاء في معالجات الاستدعاءات"""
+    # functools.wraps يسمح لـ aiogram بقراءة توقيع الدالة الأصلية وتمرير معاملاتها فقط
+    @functools.wraps(func)
     async def wrapper(callback: types.CallbackQuery, *args, **kwargs):
+        if is_duplicate_callback(callback.id):
+            logger.info("تم تجاهل استدعاء مكرر: %s", callback.id)
+            return
+
         try:
-            debug_callback_data(callback, func.__name__)
-            return await func(callback, *args)
+            if DEBUG_CALLBACKS:
+                debug_callback_data(callback, func.__name__)
+            return await func(callback, *args, **kwargs)
         except Exception as e:
-            logger.error(f"خطأ في {func.__name__}: {str(e)}")
-            logger.error(f"تفاصيل الخطأ: {traceback.format_exc()}")
+            if is_not_modified_error(e):
+                return
+            log_error(f"خطأ في {func.__name__}", e)
 
             # محاولة إرسال رسالة خطأ للمستخدم
             try:
@@ -94,32 +256,356 @@ def safe_callback_handler(func):
                 else:
                     await callback.answer("خطأ في النظام", show_alert=True)
             except Exception as answer_error:
-                logger.error(f"فشل في إرسال رسالة الخطأ: {answer_error}")
+                logger.error("فشل في إرسال رسالة الخطأ: %s", answer_error)
 
     return wrapper
 
+# === وسائط المعالجة (Middlewares) ===
+
+def _update_order_key(update: types.Update):
+    """مفتاح الترتيب للتحديث: التحديثات بنفس المفتاح تُعالج بالتسلسل"""
+    if update.callback_query:
+        callback = update.callback_query
+        if callback.inline_message_id:
+            return callback.inline_message_id
+        if callback.message:
+            return callback.message.chat.id
+        return callback.from_user.id
+    if update.message:
+        return update.message.chat.id
+    if update.inline_query:
+        return update.inline_query.from_user.id
+    if update.chat_member:
+        return update.chat_member.chat.id
+    return None
+
+class ConcurrencyMiddleware(BaseMiddleware):
+    """معالجة التحديثات بالتوازي بين المحادثات مع الحفاظ على الترتيب داخل كل محادثة"""
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        # هيكل: {order_key: [lock, عدد_المنتظرين]}
+        self._locks: Dict[object, list] = {}
+
+    async def __call__(self, handler, event: types.Update, data: Dict):
+        key = _update_order_key(event)
+        if key is None:
+            async with self._semaphore:
+                return await handler(event, data)
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                async with self._semaphore:
+                    return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+dp.update.outer_middleware(ConcurrencyMiddleware(UPDATE_CONCURRENCY))
+
+class ApiLimitMiddleware(BaseRequestMiddleware):
+    """تحديد عدد طلبات Telegram API المتزامنة مع إعادة المحاولة عند RetryAfter"""
+
+    def __init__(self, limit: int, attempts: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._attempts = attempts
+
+    async def __call__(self, make_request, bot: Bot, method):
+        for attempt in range(self._attempts):
+            try:
+                async with self._semaphore:
+                    return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                # لا فائدة من إعادة تعديل قديم إذا كان هناك تعديل أحدث لنفس الرسالة بانتظاره
+                if attempt + 1 == self._attempts or is_superseded_edit(method):
+                    raise
+                # الانتظار خارج الإشارة حتى لا تُحجز مقاعد الطلبات الأخرى
+                logger.warning("تجاوز حد Telegram، إعادة المحاولة بعد %s ثانية", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+                if is_superseded_edit(method):
+                    raise
+
+bot.session.middleware(ApiLimitMiddleware(API_CONCURRENCY, API_RETRY_ATTEMPTS))
+
+# === طابور الرسائل الصادرة ===
+
+class OutboundQueue:
+    """طابور التعديلات الصادرة: يدمج تعديلات نفس الرسالة خلال نافذة قصيرة ويرسل آخرها فقط"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # هيكل: {message_key: دالة_الإرسال}
+        self._pending: Dict[object, Callable[[], Awaitable]] = {}
+        # رسائل لديها تعديل قيد الإرسال، وأخرى حان وقتها وتنتظر انتهاءه
+        self._in_flight: set = set()
+        self._deferred: set = set()
+        self._tasks: set = set()
+
+    def submit(self, key, send: Callable[[], Awaitable]):
+        """جدولة تعديل للرسالة؛ التعديل الأحدث يحل محل السابق قبل الإرسال"""
+        if key not in self._pending:
+            self._queue.put_nowait((time.monotonic() + self.window, key))
+        self._pending[key] = send
+
+    def is_pending(self, key) -> bool:
+        """هل يوجد تعديل لم يُرسل بعد لهذه الرسالة"""
+        return key in self._pending
+
+    async def run(self):
+        """حلقة العامل: إرسال كل تعديل عند انتهاء نافذته"""
+        while True:
+            due, key = await self._queue.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # تعديل واحد فقط لكل رسالة في نفس الوقت حتى لا يصل تعديل قديم بعد أحدث منه
+            if key in self._in_flight:
+                self._deferred.add(key)
+                continue
+            self._start(key)
+
+    async def flush(self):
+        """إرسال كل التعديلات المعلقة فوراً وانتظار اكتمالها (عند الإيقاف)"""
+        for key in list(self._pending):
+            if key in self._in_flight:
+                self._deferred.add(key)
+            else:
+                self._start(key)
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _start(self, key):
+        send = self._pending.pop(key)
+        self._in_flight.add(key)
+        task = asyncio.create_task(self._send(key, send))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, key, send: Callable[[], Awaitable]):
+        try:
+            await send()
+        except Exception as e:
+            # الرسالة تعرض المحتوى المطلوب بالفعل، فلا حاجة لتسجيل أو إعادة إرسال
+            if is_not_modified_error(e):
+                return
+            # تعديل أحدث معلق سيحل محل هذا التعديل الذي لم يُعد إرساله
+            if isinstance(e, TelegramRetryAfter) and self.is_pending(key):
+                return
+            # السماح بإعادة إرسال نفس المحتوى لاحقاً
+            _LAST_EDIT_HASH.pop(key, None)
+            log_error("❌ فشل في إرسال التعديل", e)
+        finally:
+            self._in_flight.discard(key)
+            # إرسال أحدث تعديل انتظر انتهاء هذا الإرسال
+            if key in self._deferred:
+                self._deferred.discard(key)
+                self._start(key)
+
+outbound_queue = OutboundQueue(EDIT_COALESCE_WINDOW)
+
+def is_superseded_edit(method) -> bool:
+    """هل طلب تعديل الرسالة هذا أصبح قديماً بسبب تعديل أحدث في الطابور"""
+    if getattr(method, 'inline_message_id', None):
+        key = method.inline_message_id
+    elif getattr(method, 'message_id', None) and getattr(method, 'chat_id', None) is not None:
+        key = (method.chat_id, method.message_id)
+    else:
+        return False
+    return outbound_queue.is_pending(key)
+
 # === دوال مساعدة ===
 
-def create_main_menu_keyboard():
-    """إنشاء لوحة مفاتيح الشاشة الرئيسية"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔥 ابدأ التحدي الآن!", callback_data="start_challenge")],
-        [InlineKeyboardButton(text="📚 تعلم كيفية اللعب", callback_data="how_to_play")],
-        [InlineKeyboardButton(text="💬 تواصل مع المطور", url=f"https://t.me/{DEVELOPER_USERNAME}")]
-    ])
-    return keyboard
+def _message_key(callback: types.CallbackQuery):
+    """مفتاح يميز الرسالة المرتبطة بالاستدعاء"""
+    if callback.inline_message_id:
+        return callback.inline_message_id
+    if callback.message:
+        return (callback.message.chat.id, callback.message.message_id)
+    return None
 
-def create_subscription_keyboard():
-    """إنشاء لوحة مفاتيح التحقق من الاشتراك"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🌟 انضم للقناة الآن", url=f"https://t.me/{CHANNEL_USERNAME}")],
-        [InlineKeyboardButton(text="✅ لقد انضممت، تحقق الآن!", callback_data="check_subscription")]
+async def safe_edit(callback: types.CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup) -> bool:
+    """جدولة تعديل رسالة الاستدعاء وتخطيه إذا طابق آخر محتوى مُرسل (أخطاء الإرسال تُسجل في الطابور فقط ولا تُرفع هنا)"""
+    key = _message_key(callback)
+    if key is None:
+        logger.error("❌ لا توجد رسالة لتعديلها!")
+        return False
+
+    edit_hash = hash((text, repr(reply_markup.inline_keyboard)))
+    if _LAST_EDIT_HASH.get(key) == edit_hash:
+        return False
+
+    if callback.message:
+        send = functools.partial(callback.message.edit_text, text, reply_markup=reply_markup)
+    else:
+        send = functools.partial(
+            bot.edit_message_text,
+            text=text,
+            inline_message_id=callback.inline_message_id,
+            reply_markup=reply_markup
+        )
+    outbound_queue.submit(key, send)
+
+    _LAST_EDIT_HASH[key] = edit_hash
+    _LAST_EDIT_HASH.move_to_end(key)
+    if len(_LAST_EDIT_HASH) > LAST_EDIT_CACHE_SIZE:
+        _LAST_EDIT_HASH.popitem(last=False)
+    return True
+
+# === النصوص الثابتة ===
+
+SUBSCRIPTION_TEXT: Final = """
+🎮 أهلاً وسهلاً! مرحباً بك في بوت XO الرائع!
+
+🔔 للاستمتاع بجميع الميزات المذهلة، يرجى الانضمام لقناتنا أولاً
+
+✨ ستحصل على:
+• ألعاب لا محدودة مع الأصدقاء
+• تحديثات جديدة ومثيرة
+• مسابقات وجوائز حصرية
+
+👇 انضم الآن ولنبدأ المتعة!
+""".strip()
+
+WELCOME_TEXT: Final = """
+🎯 مرحباً بك في عالم لعبة XO المثيرة!
+
+⚡ اختبر مهاراتك في أشهر لعبة استراتيجية
+🏆 تحدَّ أصدقائك واستمتع بالمنافسة
+🎮 لعبة سريعة ومسلية في أي وقت
+
+ماذا تريد أن تفعل؟
+""".strip()
+
+VERIFIED_WELCOME_TEXT: Final = "🎉 رائع! تم التحقق بنجاح!\n\n" + WELCOME_TEXT
+
+INSTRUCTIONS_TEXT: Final = """
+📖 كيفية اللعب:
+
+1️⃣ ابدأ التحدي: اضغط على "🔥 ابدأ التحدي الآن!"
+
+2️⃣ اختر المحادثة: اضغط على "▶️ اختر المحادثة" واختر الدردشة التي تريد إرسال التحدي إليها
+
+3️⃣ أرسل التحدي: سيتم إرسال رسالة التحدي تلقائياً في الدردشة المختارة
+
+4️⃣ الانضمام للعبة: 
+   • يجب على كلا اللاعبين الضغط على "🎮 انضم للعبة"
+   • اللاعب الأول الذي يضغط يصبح ❌ (إكس)
+   • اللاعب الثاني الذي يضغط يصبح ⭕ (أو)
+
+5️⃣ ابدأ اللعب: 
+   • ستظهر شبكة 3×3 بعد انضمام كلا اللاعبين
+   • اضغط على المربعات للعب
+   • اللعب بالتناوب - اللاعب الأول (❌) يبدأ
+
+6️⃣ الفوز: اربط 3 رموز متتالية (أفقياً، عمودياً، أو قطرياً)
+
+7️⃣ إعادة اللعب: بعد انتهاء الجولة يمكنك الضغط على "🔄 إعادة اللعب"
+   • ملاحظة: عند إعادة اللعب يتم تبديل الأدوار تلقائياً!
+
+🎯 اللاعب الأول: ❌ (إكس) - يبدأ اللعب
+🎯 اللاعب الثاني: ⭕ (أو) - يلعب بعد الأول
+⚡ التناوب: كل لاعب يلعب في دوره فقط
+🔄 تبديل الأدوار: عند إعادة اللعب يصبح اللاعب الثاني هو الأول والعكس
+""".strip()
+
+CHALLENGE_TEXT: Final = """
+🎯 حان وقت التحدي!
+
+🔥 اضغط الزر أدناه لاختيار المحادثة
+📤 سيتم إرسال تحدي مثير لأصدقائك
+⚡ من سيكون الفائز؟ اكتشف الآن!
+
+👇 اختر المحادثة وابدأ المعركة!
+""".strip()
+
+DELETE_TEXT: Final = """
+🗑️ تم حذف اللعبة بنجاح!
+
+✨ يمكنك بدء تحدي جديد في أي وقت
+🎮 اضغط على الزر أدناه لإنشاء لعبة جديدة
+
+🔥 هل أنت مستعد للمزيد من التحدي؟
+""".strip()
+
+DEFAULT_RESET_TEXT: Final = """
+🎯 تحدي XO جديد وحماسي!
+
+🔥 هل أنت مستعد لجولة جديدة?
+⚡ لعبة سريعة ومثيرة تنتظرك!
+🏆 من سيكون بطل هذه المرة؟
+
+👇 اقبل التحدي وابدأ المعركة!
+""".strip()
+
+INLINE_CHALLENGE_TEXT: Final = """
+🎯 تحدي XO حماسي!
+
+🔥 هل أنت مستعد لإثبات مهاراتك?
+⚡ لعبة سريعة ومثيرة تنتظرك!
+🏆 من سيكون بطل هذه الجولة؟
+
+👇 اقبل التحدي وابدأ المعركة!
+""".strip()
+
+RESET_SWAP_NOTE: Final = "\n\n🔄 تم إعادة اللعبة! تم تبديل الأدوار بين اللاعبين."
+
+# لوحات المفاتيح الثابتة تُبنى مرة واحدة عند التحميل
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔥 ابدأ التحدي الآن!", callback_data="start_challenge")],
+    [InlineKeyboardButton(text="📚 تعلم كيفية اللعب", callback_data="how_to_play")],
+    [InlineKeyboardButton(text="💬 تواصل مع المطور", url=f"https://t.me/{DEVELOPER_USERNAME}")]
+])
+
+SUBSCRIPTION_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🌟 انضم للقناة الآن", url=f"https://t.me/{CHANNEL_USERNAME}")],
+    [InlineKeyboardButton(text="✅ لقد انضممت، تحقق الآن!", callback_data="check_subscription")]
+])
+
+HOW_TO_PLAY_BACK_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")]
+])
+
+START_CHALLENGE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="▶️ اختر المحادثة", switch_inline_query="play_xo")],
+    [InlineKeyboardButton(text="🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")]
+])
+
+NEW_CHALLENGE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🎮 ابدأ تحدي جديد!", callback_data=JoinCB(game_id=NEW_GAME_ID).pack())]
+])
+
+@functools.lru_cache(maxsize=4096)
+def create_join_keyboard(game_id: str, text: str = "🎮 انضم للعبة") -> InlineKeyboardMarkup:
+    """إنشاء زر الانضمام للعبة (مُخزن مؤقتاً لكل معرف، لا يجب تعديله)"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=JoinCB(game_id=game_id).pack())]
     ])
+
+def create_game_board(game_data: GameState, game_id: str) -> InlineKeyboardMarkup:
+    """إرجاع لوحة اللعبة المخزنة مع استبدال أزرار الخانات التي تغيرت فقط"""
+    keyboard = game_data.keyboard
+    if keyboard is None:
+        keyboard = game_data.keyboard = _build_game_board(game_data.board, game_id)
+        return keyboard
+
+    # الأزرار كائنات قابلة للتعديل، لذا يُحدث نص الخانة المتغيرة في مكانه دون بناء زر جديد
+    for pos, cell in enumerate(game_data.board):
+        button = keyboard.inline_keyboard[pos // 3][pos % 3]
+        text = _CELL_TEXT[cell]
+        if button.text != text:
+            button.text = text
     return keyboard
 
-def create_game_board(game_data: Dict, game_id: str) -> InlineKeyboardMarkup:
-    """إنشاء شبكة اللعبة 3x3 مع أزرار التحكم"""
-    board = game_data['board']
+def _build_game_board(board: bytearray, game_id: str) -> InlineKeyboardMarkup:
+    """بناء لوحة اللعبة 3x3 مع أزرار التحكم مرة واحدة لكل لعبة"""
     keyboard = []
 
     # إنشاء شبكة 3x3 من الأزرار
@@ -127,191 +613,212 @@ def create_game_board(game_data: Dict, game_id: str) -> InlineKeyboardMarkup:
         row = []
         for j in range(3):
             pos = i * 3 + j
-            text = board[pos] if board[pos] else "⬜"
-            callback_data = f"move_{game_id}_{pos}"
+            text = _CELL_TEXT[board[pos]]
+            callback_data = MoveCB(game_id=game_id, pos=pos).pack()
             row.append(InlineKeyboardButton(text=text, callback_data=callback_data))
         keyboard.append(row)
 
     # إضافة أزرار التحكم
     control_buttons = [
-        InlineKeyboardButton(text="🔄 إعادة اللعب", callback_data=f"reset_{game_id}"),
-        InlineKeyboardButton(text="🗑️ حذف اللعبة", callback_data=f"delete_{game_id}")
+        InlineKeyboardButton(text="🔄 إعادة اللعب", callback_data=ResetCB(game_id=game_id).pack()),
+        InlineKeyboardButton(text="🗑️ حذف اللعبة", callback_data=DeleteCB(game_id=game_id).pack())
     ]
 
     keyboard.append(control_buttons)
 
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-def check_winner(board: List[str]) -> Optional[str]:
-    """فحص الفائز في اللعبة"""
-    # خطوط الفوز المحتملة
-    winning_lines = [
-        [0, 1, 2], [3, 4, 5], [6, 7, 8],  # الصفوف
-        [0, 3, 6], [1, 4, 7], [2, 5, 8],  # الأعمدة
-        [0, 4, 8], [2, 4, 6]              # الأقطار
-    ]
-
-    for line in winning_lines:
-        if board[line[0]] and board[line[0]] == board[line[1]] == board[line[2]]:
-            return board[line[0]]
+@functools.lru_cache(maxsize=20000)
+def check_winner(p1_mask: int, p2_mask: int) -> Optional[str]:
+    """فحص الفائز في اللعبة عبر أقنعة البتات (عدد الحالات الممكنة لا يتجاوز 3^9)"""
+    for win_mask in _WIN_MASKS:
+        if p1_mask & win_mask == win_mask:
+            return X_SYMBOL
+        if p2_mask & win_mask == win_mask:
+            return O_SYMBOL
 
     return None
 
-def is_board_full(board: List[str]) -> bool:
+def is_board_full(p1_mask: int, p2_mask: int) -> bool:
     """فحص امتلاء الشبكة (تعادل)"""
-    return all(cell != "" for cell in board)
+    return (p1_mask | p2_mask) == FULL_BOARD_MASK
 
 async def check_user_subscription(user_id: int) -> bool:
-    """التحقق من اشتراك المستخدم في القناة"""
+    """التحقق من اشتراك المستخدم في القناة مع ذاكرة مؤقتة"""
+    cached = SUB_CACHE.get(user_id)
+    if cached:
+        cached_at, is_subscribed = cached
+        ttl = SUB_CACHE_TTL if is_subscribed else SUB_CACHE_NEGATIVE_TTL
+        if time.monotonic() - cached_at < ttl:
+            return is_subscribed
+
     try:
         member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
-    except Exception as e:
-        logger.error(f"خطأ في التحقق من الاشتراك: {e}")
+        is_subscribed = member.status in SUBSCRIBED_STATUSES
+        SUB_CACHE[user_id] = (time.monotonic(), is_subscribed)
+        return is_subscribed
+    except Exception:
+        logger.exception("خطأ في التحقق من الاشتراك")
         return False
 
 def create_unique_game_id():
-    """إنشاء معرف فريد للعبة"""
-    return str(uuid.uuid4())
+    """إنشاء معرف فريد قصير للعبة (8 أحرف base64 آمنة للروابط، 48 بت)"""
+    return secrets.token_urlsafe(6)
 
-def find_game_by_id(game_id: str):
-    """البحث عن اللعبة في جميع المستخدمين"""
-    for user_id, user_games in games.items():
-        if game_id in user_games:
-            return user_id, user_games[game_id]
-    return None, None
+def game_id_for_message(callback: types.CallbackQuery) -> str:
+    """اشتقاق معرف اللعبة من الرسالة لزر التحدي الجديد (النقرات المتزامنة على نفس الرسالة تصل لنفس اللعبة)"""
+    key = _message_key(callback)
+    if key is None:
+        return create_unique_game_id()
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=6).digest()
+    return base64.urlsafe_b64encode(digest).decode()
 
-def format_game_text(game_data: Dict) -> str:
+def find_game_by_id(game_id: str):
+    """البحث عن اللعبة عبر الفهرس المباشر"""
+    game_data = GAME_INDEX.get(game_id)
+    return (game_data.owner_id, game_data) if game_data else (None, None)
+
+def add_game(owner_id: int, game_id: str, game_data: GameState):
+    """تسجيل لعبة لدى مالكها وفي الفهرس مع إخراج الأقدم عند تجاوز الحد"""
+    game_data.owner_id = owner_id
+    games.setdefault(owner_id, {})[game_id] = game_data
+    GAME_INDEX[game_id] = game_data
+    bot_status['total_games'] += 1
+
+    while len(GAME_INDEX) > MAX_GAMES:
+        oldest_id, oldest_game = next(iter(GAME_INDEX.items()))
+        remove_game(oldest_game.owner_id, oldest_id)
+        logger.info("تم إخراج اللعبة الأقدم %s لتجاوز الحد الأقصى", oldest_id)
+
+def touch_game(game_id: str, game_data: GameState):
+    """تحديث وقت آخر نشاط للعبة"""
+    game_data.last_activity = time.monotonic()
+    GAME_INDEX.move_to_end(game_id)
+
+def remove_game(owner_id: int, game_id: str):
+    """حذف لعبة من مالكها ومن الفهرس"""
+    del games[owner_id][game_id]
+    GAME_INDEX.pop(game_id, None)
+
+    # إذا لم تعد هناك ألعاب لهذا المستخدم، احذف مدخل المستخدم
+    if not games[owner_id]:
+        del games[owner_id]
+        logger.info("تم حذف مدخل المستخدم %s لعدم وجود ألعاب", owner_id)
+
+def prepare_rematch(game_data: GameState):
+    """تجهيز كائن اللعبة نفسه لجولة جديدة مع تبديل الأدوار والنقاط بدلاً من إنشاء كائن جديد"""
+    game_data.player1_id, game_data.player2_id = game_data.player2_id, game_data.player1_id
+    game_data.player1_username, game_data.player2_username = game_data.player2_username, game_data.player1_username
+    game_data.player1_wins, game_data.player2_wins = game_data.player2_wins, game_data.player1_wins
+
+    # تفريغ الشبكة في مكانها؛ لوحة الأزرار تُزامن خاناتها عند العرض التالي
+    game_data.board[:] = bytes(9)
+    game_data.p1_mask = 0
+    game_data.p2_mask = 0
+    game_data.current_player = 'X'
+    game_data.game_over = False
+    game_data.winner = None
+    game_data.waiting_for_second_player = False
+    game_data.header = None
+    game_data.last_activity = time.monotonic()
+
+def sweep_inactive_games() -> int:
+    """حذف الألعاب التي تجاوزت مدة عدم النشاط"""
+    now = time.monotonic()
+    removed = 0
+    while GAME_INDEX:
+        game_id, game_data = next(iter(GAME_INDEX.items()))
+        if now - game_data.last_activity < GAME_TTL:
+            break
+        remove_game(game_data.owner_id, game_id)
+        removed += 1
+    return removed
+
+def sweep_subscription_cache() -> int:
+    """حذف نتائج الاشتراك المنتهية من الذاكرة المؤقتة"""
+    now = time.monotonic()
+    expired = [
+        user_id for user_id, (cached_at, is_subscribed) in SUB_CACHE.items()
+        if now - cached_at >= (SUB_CACHE_TTL if is_subscribed else SUB_CACHE_NEGATIVE_TTL)
+    ]
+    for user_id in expired:
+        del SUB_CACHE[user_id]
+    return len(expired)
+
+async def games_gc_loop():
+    """مهمة خلفية لتنظيف الألعاب المهجورة ونتائج الاشتراك المنتهية دورياً"""
+    while True:
+        await asyncio.sleep(GAME_GC_INTERVAL)
+        removed = sweep_inactive_games()
+        if removed:
+            logger.info("🧹 تم حذف %s لعبة غير نشطة", removed)
+        sweep_subscription_cache()
+
+def _game_header(game_data: GameState) -> str:
+    """سطور النقاط والأدوار (مُخزنة في حالة اللعبة حتى يتغير اللاعبون أو النقاط)"""
+    header = game_data.header
+    if header is None:
+        player1_name = game_data.player1_username
+        player2_name = game_data.player2_username or "في الانتظار..."
+        header = game_data.header = "".join((
+            "👤 **", player1_name, "**: ", str(game_data.player1_wins), " انتصارات\n",
+            "👤 **", player2_name, "**: ", str(game_data.player2_wins), " انتصارات\n\n",
+            "🔷 **الأدوار الثابتة**:\n",
+            "- ", player1_name, " يلعب ❌ (X)\n",
+            "- ", game_data.player2_username or '', " يلعب ⭕ (O)"
+        ))
+    return header
+
+def format_game_text(game_data: GameState) -> str:
     """تنسيق نص اللعبة بشكل جذاب"""
-    # استخراج معلومات اللاعبين
-    player1_name = game_data['player1_username']
-    player2_name = game_data.get('player2_username', "في الانتظار...")
-    
-    # استخراج النقاط
-    player1_wins = game_data.get('player1_wins', 0)
-    player2_wins = game_data.get('player2_wins', 0)
-    
-    # تحديد الأدوار الثابتة (بدون تغيير)
-    player_x_name = game_data['player1_username']
-    player_o_name = game_data.get('player2_username', '')
-    
-    # تحديد دور اللاعب التالي
-    next_player_name = game_data['player1_username'] if game_data['current_player'] == 'X' else game_data.get('player2_username', '')
-    next_symbol = "❌" if game_data['current_player'] == 'X' else "⭕"
-
-    if game_data.get('waiting_for_second_player', False):
-        return f"""
-🎮 **تحدي XO الجديد!**
+    header = _game_header(game_data)
 
-👤 **{player1_name}**: {player1_wins} انتصارات
-👤 **{player2_name}**: {player2_wins} انتصارات
+    if game_data.waiting_for_second_player:
+        return "\n🎮 **تحدي XO الجديد!**\n\n" + header + "\n\n⏳ في انتظار اللاعب الثاني للانضمام!\n        "
 
-🔷 **الأدوار الثابتة**:
-- {player_x_name} يلعب ❌ (X)
-- {player_o_name} يلعب ⭕ (O)
+    if game_data.game_over:
+        if game_data.winner:
+            winner_name = game_data.player1_username if game_data.winner == X_SYMBOL else (game_data.player2_username or '')
+            return f"\n🏁 **انتهت اللعبة!**\n\n🎉 **الفائز**: {winner_name} {game_data.winner}\n\n{header}\n        "
+        return "\n🤝 **انتهت اللعبة!**\n\n⚖️ **النتيجة**: تعادل!\n\n" + header + "\n        "
 
-⏳ في انتظار اللاعب الثاني للانضمام!
-        """
-    
-    if game_data.get('game_over', False):
-        if game_data['winner']:
-            winner_name = player_x_name if game_data['winner'] == "❌" else player_o_name
-            return f"""
-🏁 **انتهت اللعبة!**
-
-🎉 **الفائز**: {winner_name} {game_data['winner']}
-
-👤 **{player1_name}**: {player1_wins} انتصارات
-👤 **{player2_name}**: {player2_wins} انتصارات
-
-🔷 **الأدوار الثابتة**:
-- {player_x_name} يلعب ❌ (X)
-- {player_o_name} يلعب ⭕ (O)
-        """
-        else:
-            return f"""
-🤝 **انتهت اللعبة!**
-
-⚖️ **النتيجة**: تعادل!
-
-👤 **{player1_name}**: {player1_wins} انتصارات
-👤 **{player2_name}**: {player2_wins} انتصارات
-
-🔷 **الأدوار الثابتة**:
-- {player_x_name} يلعب ❌ (X)
-- {player_o_name} يلعب ⭕ (O)
-        """
-    
-    # حالة اللعبة الجارية
-    return f"""
-🎮 **جولة XO مستمرة!**
-
-👤 **{player1_name}**: {player1_wins} انتصارات
-👤 **{player2_name}**: {player2_wins} انتصارات
-
-🔷 **الأدوار الثابتة**:
-- {player_x_name} يلعب ❌ (X)
-- {player_o_name} يلعب ⭕ (O)
-
-⏰ **دور**: {next_player_name} {next_symbol}
-    """
+    # حالة اللعبة الجارية: يتغير سطر الدور فقط
+    if game_data.current_player == 'X':
+        turn_line = f"⏰ **دور**: {game_data.player1_username} {X_SYMBOL}"
+    else:
+        turn_line = f"⏰ **دور**: {game_data.player2_username or ''} {O_SYMBOL}"
+    return "\n🎮 **جولة XO مستمرة!**\n\n" + header + "\n\n" + turn_line + "\n    "
 
 # === معالجات الأوامر ===
 
 @dp.message(Command("start"))
-async def cmd_start(message: types.Message, state: FSMContext):
+async def cmd_start(message: types.Message):
     """معالج أمر /start"""
     user_id = message.from_user.id
-    logger.info(f"مستخدم جديد بدأ البوت: {user_id}")
+    logger.info("مستخدم جديد بدأ البوت: %s", user_id)
 
     # التحقق من اشتراك المستخدم
     is_subscribed = await check_user_subscription(user_id)
 
     if not is_subscribed:
         # إرسال رسالة طلب الاشتراك
-        welcome_subscription_text = """
-🎮 أهلاً وسهلاً! مرحباً بك في بوت XO الرائع!
-
-🔔 للاستمتاع بجميع الميزات المذهلة، يرجى الانضمام لقناتنا أولاً
-
-✨ ستحصل على:
-• ألعاب لا محدودة مع الأصدقاء
-• تحديثات جديدة ومثيرة
-• مسابقات وجوائز حصرية
-
-👇 انضم الآن ولنبدأ المتعة!
-        """
-        await message.answer(
-            welcome_subscription_text,
-            reply_markup=create_subscription_keyboard()
-        )
-        await state.set_state(XOStates.waiting_subscription)
+        await message.answer(SUBSCRIPTION_TEXT, reply_markup=SUBSCRIPTION_KB)
     else:
         # الانتقال للشاشة الرئيسية
         await show_main_menu(message)
-        await state.set_state(XOStates.main_menu)
 
 async def show_main_menu(message: types.Message):
     """عرض الشاشة الرئيسية"""
-    welcome_text = """
-🎯 مرحباً بك في عالم لعبة XO المثيرة!
-
-⚡ اختبر مهاراتك في أشهر لعبة استراتيجية
-🏆 تحدَّ أصدقائك واستمتع بالمنافسة
-🎮 لعبة سريعة ومسلية في أي وقت
-
-ماذا تريد أن تفعل؟
-    """
     await message.answer(
-        welcome_text,
-        reply_markup=create_main_menu_keyboard()
+        WELCOME_TEXT,
+        reply_markup=MAIN_MENU_KB
     )
 
 # === معالجات الاستدعاءات (Callbacks) ===
 
-@dp.callback_query(lambda c: c.data == "check_subscription")
+@dp.callback_query(F.data == "check_subscription")
 @safe_callback_handler
-async def check_subscription_callback(callback: types.CallbackQuery):
+async def check_subscription_callback(callback: types.CallbackQuery, state: FSMContext):
     """معالج زر التحقق من الاشتراك"""
     user_id = callback.from_user.id
 
@@ -321,206 +828,111 @@ async def check_subscription_callback(callback: types.CallbackQuery):
         await callback.answer("يجب الاشتراك أولاً.", show_alert=True)
         return
 
-    # إذا اشترك المستخدم
-    await callback.message.edit_text(
-        """
-🎉 رائع! تم التحقق بنجاح!
-
-🎯 مرحباً بك في عالم لعبة XO المثيرة!
-
-⚡ اختبر مهاراتك في أشهر لعبة استراتيجية
-🏆 تحدَّ أصدقائك واستمتع بالمنافسة
-🎮 لعبة سريعة ومسلية في أي وقت
+    # إذا كانت هذه الرسالة تعرض القائمة الرئيسية بالفعل (ضغطة مكررة) فلا داعي للتعديل
+    message_id = callback.message.message_id if callback.message else None
+    user_data = await state.get_data()
+    if message_id and user_data.get('menu_message_id') == message_id:
+        await callback.answer("✅")
+        return
 
-ماذا تريد أن تفعل؟
-        """,
-        reply_markup=create_main_menu_keyboard()
-    )
-    await callback.answer("تم التحقق بنجاح!")
+    # إذا اشترك المستخدم
+    await safe_edit(callback, VERIFIED_WELCOME_TEXT, MAIN_MENU_KB)
+    if message_id:
+        # كائن الطريقة قابل للانتظار لكنه لا يقبل التجزئة التي يحتاجها gather، لذا يُمرر عبر bot()
+        await asyncio.gather(
+            state.update_data(menu_message_id=message_id),
+            bot(callback.answer("تم التحقق بنجاح!"))
+        )
+    else:
+        await callback.answer("تم التحقق بنجاح!")
 
-@dp.callback_query(lambda c: c.data == "how_to_play")
+@dp.callback_query(F.data == "how_to_play")
 @safe_callback_handler
 async def how_to_play_callback(callback: types.CallbackQuery):
     """معالج زر كيفية اللعب"""
-    instructions = """
-📖 كيفية اللعب:
-
-1️⃣ ابدأ التحدي: اضغط على "🔥 ابدأ التحدي الآن!"
-
-2️⃣ اختر المحادثة: اضغط على "▶️ اختر المحادثة" واختر الدردشة التي تريد إرسال التحدي إليها
+    await safe_edit(callback, INSTRUCTIONS_TEXT, HOW_TO_PLAY_BACK_KB)
 
-3️⃣ أرسل التحدي: سيتم إرسال رسالة التحدي تلقائياً في الدردشة المختارة
-
-4️⃣ الانضمام للعبة: 
-   • يجب على كلا اللاعبين الضغط على "🎮 انضم للعبة"
-   • اللاعب الأول الذي يضغط يصبح ❌ (إكس)
-   • اللاعب الثاني الذي يضغط يصبح ⭕ (أو)
-
-5️⃣ ابدأ اللعب: 
-   • ستظهر شبكة 3×3 بعد انضمام كلا اللاعبين
-   • اضغط على المربعات للعب
-   • اللعب بالتناوب - اللاعب الأول (❌) يبدأ
-
-6️⃣ الفوز: اربط 3 رموز متتالية (أفقياً، عمودياً، أو قطرياً)
-
-7️⃣ إعادة اللعب: بعد انتهاء الجولة يمكنك الضغط على "🔄 إعادة اللعب"
-   • ملاحظة: عند إعادة اللعب يتم تبديل الأدوار تلقائياً!
-
-🎯 اللاعب الأول: ❌ (إكس) - يبدأ اللعب
-🎯 اللاعب الثاني: ⭕ (أو) - يلعب بعد الأول
-⚡ التناوب: كل لاعب يلعب في دوره فقط
-🔄 تبديل الأدوار: عند إعادة اللعب يصبح اللاعب الثاني هو الأول والعكس
-    """
-
-    # إنشاء لوحة مفاتيح مع زر العودة
-    back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")]
-    ])
-
-    await callback.message.edit_text(
-        instructions,
-        reply_markup=back_keyboard
-    )
-
-@dp.callback_query(lambda c: c.data == "start_challenge")
+@dp.callback_query(F.data == "start_challenge")
 @safe_callback_handler
 async def start_challenge_callback(callback: types.CallbackQuery):
     """معالج زر تحدي اللعبة"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="▶️ اختر المحادثة", switch_inline_query="play_xo")],
-        [InlineKeyboardButton(text="🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")]
-    ])
+    await safe_edit(callback, CHALLENGE_TEXT, START_CHALLENGE_KB)
 
-    challenge_message = """
-🎯 حان وقت التحدي!
-
-🔥 اضغط الزر أدناه لاختيار المحادثة
-📤 سيتم إرسال تحدي مثير لأصدقائك
-⚡ من سيكون الفائز؟ اكتشف الآن!
-
-👇 اختر المحادثة وابدأ المعركة!
-    """
-    await callback.message.edit_text(
-        challenge_message,
-        reply_markup=keyboard
-    )
-
-@dp.callback_query(lambda c: c.data.startswith("join_challenge"))
+@dp.callback_query(JoinCB.filter())
 @safe_callback_handler
-async def join_challenge_callback(callback: types.CallbackQuery):
+async def join_challenge_callback(callback: types.CallbackQuery, callback_data: JoinCB):
     """معالج زر الانضمام للتحدي - نظام لاعبين محسن"""
 
-    # استخراج معرف اللعبة من callback_data
-    game_id = callback.data.split("_")[2]
-    logger.info(f"Game ID from callback: {game_id}")
+    game_id = callback_data.game_id
+    if game_id == NEW_GAME_ID:
+        game_id = game_id_for_message(callback)
+    logger.debug("Game ID from callback: %s", game_id)
 
     user_id = callback.from_user.id
     username = callback.from_user.username or callback.from_user.first_name
 
-    logger.info(f"محاولة انضمام اللاعب {username} (ID: {user_id}) للعبة {game_id}")
+    logger.info("محاولة انضمام اللاعب %s (ID: %s) للعبة %s", username, user_id, game_id)
 
     # البحث عن اللعبة في جميع المستخدمين
     game_owner_id, game_data = find_game_by_id(game_id)
 
     if not game_data:
         # إنشاء لعبة جديدة - اللاعب الأول (X)
-        if user_id not in games:
-            games[user_id] = {}
-
-        games[user_id][game_id] = {
-            'board': [""] * 9,
-            'current_player': 'X',
-            'player1_id': user_id,  # اللاعب الأول
-            'player2_id': None,     # في انتظار اللاعب الثاني
-            'player1_username': username,
-            'player2_username': None,
-            'game_over': False,
-            'winner': None,
-            'waiting_for_second_player': True,
-            'player1_wins': 0,  # نقاط اللاعب الأول
-            'player2_wins': 0   # نقاط اللاعب الثاني
-        }
-
-        logger.info(f"✅ تم إنشاء لعبة جديدة {game_id} - اللاعب الأول: {username}")
-
-        # تحديث رسالة اللعبة
-        game_text = format_game_text(games[user_id][game_id])
+        game_data = GameState(player1_id=user_id, player1_username=username)
+        add_game(user_id, game_id, game_data)
+
+        logger.info("✅ تم إنشاء لعبة جديدة %s - اللاعب الأول: %s", game_id, username)
 
         await callback.answer("تم الانضمام كاللاعب الأول! في انتظار اللاعب الثاني 🎮")
 
     else:
         # التحقق من أن اللاعب لم ينضم بالفعل
-        if user_id == game_data['player1_id']:
+        if user_id == game_data.player1_id:
             await callback.answer("أنت مشارك بالفعل في اللعبة كاللاعب الأول!", show_alert=True)
             return
-        elif game_data.get('player2_id') and user_id == game_data['player2_id']:
+        elif game_data.player2_id and user_id == game_data.player2_id:
             await callback.answer("أنت مشارك بالفعل في اللعبة كاللاعب الثاني!", show_alert=True)
             return
 
         # التحقق من حالة اللعبة
-        if not game_data.get('waiting_for_second_player', False):
+        if not game_data.waiting_for_second_player:
             await callback.answer("هذه اللعبة مكتملة بالفعل أو انتهت!", show_alert=True)
             return
 
-        if game_data['player2_id'] is not None:
+        if game_data.player2_id is not None:
             await callback.answer("اللعبة مكتملة بالفعل مع لاعبين!", show_alert=True)
             return
 
         # إضافة اللاعب الثاني (O)
-        games[game_owner_id][game_id]['player2_id'] = user_id
-        games[game_owner_id][game_id]['player2_username'] = username
-        games[game_owner_id][game_id]['waiting_for_second_player'] = False
+        game_data.player2_id = user_id
+        game_data.player2_username = username
+        game_data.waiting_for_second_player = False
+        game_data.header = None
+        touch_game(game_id, game_data)
 
-        logger.info(f"✅ انضم اللاعب الثاني: {username} إلى اللعبة {game_id}")
+        logger.info("✅ انضم اللاعب الثاني: %s إلى اللعبة %s", username, game_id)
 
         await callback.answer("تم الانضمام كاللاعب الثاني! بدأت اللعبة! 🎮")
 
-    try:
-        # الحصول على بيانات اللعبة المحدثة
-        updated_owner_id, current_game_data = find_game_by_id(game_id)
-
-        # إنشاء لوحة المفاتيح المناسبة
-        if current_game_data.get('waiting_for_second_player', False):
-            # إذا كان في انتظار اللاعب الثاني، إظهار زر الانضمام
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🎮 انضم للعبة", callback_data=f"join_challenge_{game_id}")]
-            ])
-        else:
-            # إذا انضم كلا اللاعبين، إظهار شبكة اللعب
-            keyboard = create_game_board(current_game_data, game_id)
-
-        # تنسيق نص اللعبة
-        game_text = format_game_text(current_game_data)
-
-        # تحديث الرسالة
-        if callback.message:
-            await callback.message.edit_text(
-                game_text,
-                reply_markup=keyboard
-            )
-        elif callback.inline_message_id:
-            await bot.edit_message_text(
-                text=game_text,
-                inline_message_id=callback.inline_message_id,
-                reply_markup=keyboard
-            )
-
-        logger.info(f"✅ تم تحديث الرسالة بنجاح للعبة {game_id}")
+    # إنشاء لوحة المفاتيح المناسبة (game_data يشير إلى اللعبة المحدثة)
+    if game_data.waiting_for_second_player:
+        # إذا كان في انتظار اللاعب الثاني، إظهار زر الانضمام
+        keyboard = create_join_keyboard(game_id)
+    else:
+        # إذا انضم كلا اللاعبين، إظهار شبكة اللعب
+        keyboard = create_game_board(game_data, game_id)
 
-    except Exception as edit_error:
-        logger.error(f"❌ فشل في تحديث الرسالة: {edit_error}")
-        logger.error(f"تفاصيل الخطأ: {traceback.format_exc()}")
-        await callback.answer("تم قبول التحدي ولكن حدث خطأ في التحديث", show_alert=True)
+    # تنسيق نص اللعبة وجدولة تحديث الرسالة
+    game_text = format_game_text(game_data)
+    await safe_edit(callback, game_text, keyboard)
 
-@dp.callback_query(lambda c: c.data.startswith("move_"))
+@dp.callback_query(MoveCB.filter())
 @safe_callback_handler
-async def game_move_callback(callback: types.CallbackQuery):
+async def game_move_callback(callback: types.CallbackQuery, callback_data: MoveCB):
     """معالج حركات اللعبة"""
 
-    # استخراج معرف اللعبة والموضع من callback_data
-    parts = callback.data.split("_")
-    game_id = parts[1]
-    position = int(parts[2])
+    game_id = callback_data.game_id
+    position = callback_data.pos
 
     user_id = callback.from_user.id
 
@@ -531,152 +943,94 @@ async def game_move_callback(callback: types.CallbackQuery):
         await callback.answer("لعبة غير موجودة!", show_alert=True)
         return
 
-    if game_data['game_over']:
+    if game_data.game_over:
         await callback.answer("اللعبة انتهت!", show_alert=True)
         return
 
     # التحقق من أن كلا اللاعبين قد انضما
-    if game_data.get('waiting_for_second_player', False):
+    if game_data.waiting_for_second_player:
         await callback.answer("في انتظار اللاعب الثاني للانضمام!", show_alert=True)
         return
 
-    # تحديد دور اللاعب
-    current_symbol = "❌" if game_data['current_player'] == 'X' else "⭕"
-
     # التحقق من أن اللاعب هو صاحب الدور
-    if game_data['current_player'] == 'X' and user_id != game_data['player1_id']:
+    if game_data.current_player == 'X' and user_id != game_data.player1_id:
         await callback.answer("ليس دورك! انتظر دورك.", show_alert=True)
         return
-    elif game_data['current_player'] == 'O' and user_id != game_data['player2_id']:
+    elif game_data.current_player == 'O' and user_id != game_data.player2_id:
         await callback.answer("ليس دورك! انتظر دورك.", show_alert=True)
         return
 
     # التحقق من أن المربع فارغ
-    if game_data['board'][position] != "":
+    if game_data.board[position]:
         await callback.answer("هذا المربع مُحتل!", show_alert=True)
         return
 
     # إضافة الحركة
-    games[game_owner_id][game_id]['board'][position] = current_symbol
-    logger.info(f"تم لعب الحركة {position} بواسطة {callback.from_user.username} في اللعبة {game_id}")
+    touch_game(game_id, game_data)
+    is_x_turn = game_data.current_player == 'X'
+    if is_x_turn:
+        game_data.board[position] = 1
+        game_data.p1_mask |= 1 << position
+    else:
+        game_data.board[position] = 2
+        game_data.p2_mask |= 1 << position
+    logger.info("تم لعب الحركة %s بواسطة %s في اللعبة %s", position, callback.from_user.username, game_id)
 
-    # فحص الفائز
-    winner = check_winner(games[game_owner_id][game_id]['board'])
-    is_full = is_board_full(games[game_owner_id][game_id]['board'])
+    # فحص الفائز (الفائز دائماً هو صاحب الحركة الأخيرة)
+    winner = check_winner(game_data.p1_mask, game_data.p2_mask)
 
     if winner:
-        games[game_owner_id][game_id]['game_over'] = True
-        games[game_owner_id][game_id]['winner'] = winner
-        
+        game_data.game_over = True
+        game_data.winner = winner
+
         # تحديث عدد مرات الفوز للاعب الفائز
-        if winner == "❌":
-            games[game_owner_id][game_id]['player1_wins'] += 1
+        if is_x_turn:
+            game_data.player1_wins += 1
         else:
-            games[game_owner_id][game_id]['player2_wins'] += 1
-    elif is_full:
-        games[game_owner_id][game_id]['game_over'] = True
+            game_data.player2_wins += 1
+        game_data.header = None
+    elif is_board_full(game_data.p1_mask, game_data.p2_mask):
+        game_data.game_over = True
     else:
         # تغيير الدور
-        games[game_owner_id][game_id]['current_player'] = 'O' if game_data['current_player'] == 'X' else 'X'
+        game_data.current_player = 'O' if is_x_turn else 'X'
 
-    try:
-        updated_game_data = games[game_owner_id][game_id]
-        game_text = format_game_text(updated_game_data)
-        
-        if callback.message:
-            await callback.message.edit_text(
-                game_text,
-                reply_markup=create_game_board(updated_game_data, game_id)
-            )
-        elif callback.inline_message_id:
-            await bot.edit_message_text(
-                text=game_text,
-                inline_message_id=callback.inline_message_id,
-                reply_markup=create_game_board(updated_game_data, game_id)
-            )
-        await callback.answer()
-    except Exception as e:
-        logger.error(f"خطأ في تحديث الرسالة: {e}")
-        await callback.answer("تم تسجيل الحركة ولكن حدث خطأ في التحديث")
+    game_text = format_game_text(game_data)
+    await safe_edit(callback, game_text, create_game_board(game_data, game_id))
+    await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "back_to_main")
+@dp.callback_query(F.data == "back_to_main")
 @safe_callback_handler
 async def back_to_main_callback(callback: types.CallbackQuery):
     """معالج زر العودة للقائمة الرئيسية"""
-    welcome_text = """
-🎯 مرحباً بك في عالم لعبة XO المثيرة!
-
-⚡ اختبر مهاراتك في أشهر لعبة استراتيجية
-🏆 تحدَّ أصدقائك واستمتع بالمنافسة
-🎮 لعبة سريعة ومسلية في أي وقت
-
-ماذا تريد أن تفعل؟
-    """
-    await callback.message.edit_text(
-        welcome_text,
-        reply_markup=create_main_menu_keyboard()
-    )
+    await safe_edit(callback, WELCOME_TEXT, MAIN_MENU_KB)
     await callback.answer("تم العودة للقائمة الرئيسية")
 
-@dp.callback_query(lambda c: c.data.startswith("delete"))
+@dp.callback_query(DeleteCB.filter())
 @safe_callback_handler
-async def delete_game_callback(callback: types.CallbackQuery):
+async def delete_game_callback(callback: types.CallbackQuery, callback_data: DeleteCB):
     """معالج زر حذف اللعبة"""
 
-    # استخراج معرف اللعبة من callback_data
-    game_id = callback.data.split("_")[1]
+    game_id = callback_data.game_id
 
     # البحث عن اللعبة وحذفها
     game_owner_id, game_data = find_game_by_id(game_id)
 
     if game_data:
-        del games[game_owner_id][game_id]
-        logger.info(f"تم حذف اللعبة {game_id} من المستخدم {game_owner_id}")
-
-        # إذا لم تعد هناك ألعاب لهذا المستخدم، احذف مدخل المستخدم
-        if not games[game_owner_id]:
-            del games[game_owner_id]
-            logger.info(f"تم حذف مدخل المستخدم {game_owner_id} لعدم وجود ألعاب")
-
-        delete_text = """
-🗑️ تم حذف اللعبة بنجاح!
-
-✨ يمكنك بدء تحدي جديد في أي وقت
-🎮 اضغط على الزر أدناه لإنشاء لعبة جديدة
-
-🔥 هل أنت مستعد للمزيد من التحدي؟
-        """
+        remove_game(game_owner_id, game_id)
+        logger.info("تم حذف اللعبة %s من المستخدم %s", game_id, game_owner_id)
 
-        delete_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎮 ابدأ تحدي جديد!", callback_data=f"join_challenge_{create_unique_game_id()}")]
-        ])
-
-        try:
-            if callback.message:
-                await callback.message.edit_text(
-                    delete_text,
-                    reply_markup=delete_keyboard
-                )
-            elif callback.inline_message_id:
-                await bot.edit_message_text(
-                    text=delete_text,
-                    inline_message_id=callback.inline_message_id,
-                    reply_markup=delete_keyboard
-                )
-            await callback.answer("تم حذف اللعبة بنجاح! 🗑️")
-        except Exception as e:
-            logger.error(f"خطأ في حذف اللعبة: {e}")
-            await callback.answer("تم حذف اللعبة")
+        await safe_edit(callback, DELETE_TEXT, NEW_CHALLENGE_KB)
+        await callback.answer("تم حذف اللعبة بنجاح! 🗑️")
     else:
         await callback.answer("اللعبة غير موجودة أو تم حذفها بالفعل!", show_alert=True)
 
-@dp.callback_query(lambda c: c.data.startswith("reset"))
+@dp.callback_query(ResetCB.filter())
 @safe_callback_handler
-async def reset_game_callback(callback: types.CallbackQuery):
+async def reset_game_callback(callback: types.CallbackQuery, callback_data: ResetCB):
     """معالج زر إعادة اللعب مع تبديل الأدوار"""
 
-    # استخراج معرف اللعبة من callback_data
-    game_id = callback.data.split("_")[1]
+    game_id = callback_data.game_id
 
     # البحث عن اللعبة
     game_owner_id, old_game_data = find_game_by_id(game_id)
@@ -685,110 +1039,67 @@ async def reset_game_callback(callback: types.CallbackQuery):
         await callback.answer("اللعبة غير موجودة!", show_alert=True)
         return
 
-    # حفظ معلومات اللاعبين قبل حذف اللعبة
-    old_data_copy = old_game_data.copy()
-    del games[game_owner_id][game_id]
-    logger.info(f"تم حذف اللعبة {game_id} من المستخدم {game_owner_id}")
-
-    # إنشاء لعبة جديدة مع تبديل الأدوار فقط
-    if old_data_copy.get('player1_id') and old_data_copy.get('player2_id'):
-        # حفظ النقاط
-        player1_wins = old_data_copy.get('player1_wins', 0)
-        player2_wins = old_data_copy.get('player2_wins', 0)
-        
-        # إنشاء اللعبة الجديدة مع تبديل الأدوار
-        games[game_owner_id][game_id] = {
-            'board': [""] * 9,
-            'current_player': 'X',
-            'player1_id': old_data_copy['player2_id'],      # اللاعب الثاني يصبح الأول
-            'player2_id': old_data_copy['player1_id'],      # اللاعب الأول يصبح الثاني
-            'player1_username': old_data_copy['player2_username'],
-            'player2_username': old_data_copy['player1_username'],
-            'game_over': False,
-            'winner': None,
-            'waiting_for_second_player': False,
-            'player1_wins': player2_wins,  # نفس النقاط للاعب الجديد الأول
-            'player2_wins': player1_wins   # نفس النقاط للاعب الجديد الثاني
-        }
+    # نفس كائن اللعبة ونفس المعرف والمالك، لذا يكفي تبديل الأدوار وتحديث النشاط دون إعادة التسجيل
+    if old_game_data.player1_id and old_game_data.player2_id:
+        prepare_rematch(old_game_data)
+        touch_game(game_id, old_game_data)
 
         # رسالة اللعبة الجديدة
-        reset_text = format_game_text(games[game_owner_id][game_id])
-        reset_text += "\n\n🔄 تم إعادة اللعبة! تم تبديل الأدوار بين اللاعبين."
+        reset_text = format_game_text(old_game_data)
+        reset_text += RESET_SWAP_NOTE
 
-        reset_keyboard = create_game_board(games[game_owner_id][game_id], game_id)
-        logger.info(f"تم إنشاء لعبة جديدة للمستخدم {game_owner_id} واللعبة {game_id}")
+        reset_keyboard = create_game_board(old_game_data, game_id)
+        logger.info("تم إنشاء لعبة جديدة للمستخدم %s واللعبة %s", game_owner_id, game_id)
 
     else:
-        # إذا لم تكن هناك بيانات كافية، العودة لرسالة التحدي العادية
-        reset_text = """
-🎯 تحدي XO جديد وحماسي!
+        # إذا لم تكن هناك بيانات كافية، حذف اللعبة والعودة لرسالة التحدي العادية
+        remove_game(game_owner_id, game_id)
+        logger.info("تم حذف اللعبة %s من المستخدم %s", game_id, game_owner_id)
+        reset_text = DEFAULT_RESET_TEXT
+        reset_keyboard = create_join_keyboard(game_id, "🎮 اقبل التحدي الجديد!")
 
-🔥 هل أنت مستعد لجولة جديدة?
-⚡ لعبة سريعة ومثيرة تنتظرك!
-🏆 من سيكون بطل هذه المرة؟
+    await safe_edit(callback, reset_text, reset_keyboard)
+    await callback.answer("تم إعادة تعيين اللعبة! 🎮")
 
-👇 اقبل التحدي وابدأ المعركة!
-        """
-        reset_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎮 اقبل التحدي الجديد!", callback_data=f"join_challenge_{game_id}")]
-        ])
+# === معالج تحديثات أعضاء القناة ===
 
-    try:
-        if callback.message:
-            await callback.message.edit_text(
-                reset_text,
-                reply_markup=reset_keyboard
-            )
-        elif callback.inline_message_id:
-            await bot.edit_message_text(
-                text=reset_text,
-                inline_message_id=callback.inline_message_id,
-                reply_markup=reset_keyboard
-            )
-        await callback.answer("تم إعادة تعيين اللعبة! 🎮")
-    except Exception as e:
-        logger.error(f"خطأ في إعادة تعيين اللعبة: {e}")
-        await callback.answer("تم إعادة تعيين اللعبة")
+@dp.chat_member()
+async def channel_member_handler(update: types.ChatMemberUpdated):
+    """تحديث ذاكرة الاشتراك عند انضمام أو مغادرة عضو للقناة"""
+    if str(update.chat.id) != str(CHANNEL_ID):
+        return
+
+    user_id = update.new_chat_member.user.id
+    SUB_CACHE[user_id] = (time.monotonic(), update.new_chat_member.status in SUBSCRIBED_STATUSES)
 
 # === معالج الاستعلامات المضمنة ===
 
+# نتيجة التحدي المضمنة ثابتة بالكامل (معرف اللعبة يُحدد عند أول نقرة)، لذا يخزنها Telegram مؤقتاً
+INLINE_CHALLENGE_RESULT = InlineQueryResultArticle(
+    id="1",
+    title="🎮 تحدي XO مثير!",
+    description="ابدأ منافسة ممتعة مع أصدقائك الآن",
+    input_message_content=InputTextMessageContent(message_text=INLINE_CHALLENGE_TEXT),
+    reply_markup=create_join_keyboard(NEW_GAME_ID, "🎮 اقبل التحدي!")
+)
+INLINE_CACHE_TIME = 300  # مدة تخزين نتيجة التحدي لدى Telegram بالثواني
+
 @dp.inline_query()
 async def inline_query_handler(inline_query: types.InlineQuery):
     """معالج الاستعلامات المضمنة"""
     try:
-        logger.info(f"استعلام مضمن من {inline_query.from_user.username}: {inline_query.query}")
+        logger.info("استعلام مضمن من %s: %s", inline_query.from_user.username, inline_query.query)
 
         if inline_query.query.strip() == "play_xo":
-            # إنشاء معرف فريد للعبة
-            game_id = create_unique_game_id()
-
-            # إنشاء نتيجة واحدة للتحدي
-            result = InlineQueryResultArticle(
-                id="1",
-                title="🎮 تحدي XO مثير!",
-                description="ابدأ منافسة ممتعة مع أصدقائك الآن",
-                input_message_content=InputTextMessageContent(
-                    message_text=f"""
-🎯 تحدي XO حماسي!
-
-🔥 هل أنت مستعد لإثبات مهاراتك?
-⚡ لعبة سريعة ومثيرة تنتظرك!
-🏆 من سيكون بطل هذه الجولة؟
-
-👇 اقبل التحدي وابدأ المعركة!
-                    """
-                ),
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🎮 اقبل التحدي!", callback_data=f"join_challenge_{game_id}")]
-                ])
+            await inline_query.answer(
+                [INLINE_CHALLENGE_RESULT],
+                cache_time=INLINE_CACHE_TIME,
+                is_personal=False
             )
-
-            await inline_query.answer([result], cache_time=0)
             logger.info("تم إرسال نتيجة الاستعلام المضمن بنجاح")
 
-    except Exception as e:
-        logger.error(f"خطأ في معالج الاستعلام المضمن: {e}")
-        logger.error(traceback.format_exc())
+    except Exception:
+        logger.exception("خطأ في معالج الاستعلام المضمن")
 
 # === إعدادات الخادم للتشغيل المستمر ===
 
@@ -798,6 +1109,7 @@ bot_status = {
     'last_heartbeat': None,
     'total_users': 0,
     'active_games': 0,
+    'total_games': 0,  # عداد تراكمي يُزاد عند تسجيل كل لعبة
     'uptime': '0 days, 0 hours, 0 minutes'
 }
 
@@ -811,181 +1123,361 @@ def update_bot_stats():
         bot_status['uptime'] = f"{days} days, {hours} hours, {minutes} minutes"
 
     bot_status['last_heartbeat'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    bot_status['active_games'] = sum(len(user_games) for user_games in games.values())
+    # الفهرس يحتوي كل لعبة مرة واحدة، لذا عدد الألعاب قراءة مباشرة بدلاً من المرور على المستخدمين
+    bot_status['active_games'] = len(GAME_INDEX)
+    bot_status['total_users'] = len(games)
+    publish_stats()
+
+# آخر لقطة إحصائيات مُرمزة لمشتركي /events، والحدث يُستبدل بعد كل تغيير لإيقاظ المنتظرين
+# رقم الإصدار يزداد مع كل لقطة حتى يعرف كل مشترك إن فاته تحديث أثناء الإرسال
+_stats_feed = {'key': None, 'body': b'', 'version': 0, 'changed': asyncio.Event(), 'closed': False}
+SSE_KEEPALIVE = 25  # ثوانٍ بين تعليقات الإبقاء على الاتصال عند عدم وجود تغيير
+
+def publish_stats():
+    """دفع لقطة جديدة لمشتركي /events فقط عند تغير الإحصائيات"""
+    # وقت آخر نبضة يتغير دائماً، لذا لا يُحسب تغييراً بحد ذاته
+    key = (bot_status['uptime'], bot_status['active_games'], bot_status['total_users'], bot_status['total_games'])
+    if key == _stats_feed['key']:
+        return
+    _stats_feed['key'] = key
+    _stats_feed['body'] = b'data: ' + orjson.dumps({
+        "timestamp": bot_status['last_heartbeat'],
+        "uptime": bot_status['uptime'],
+        "active_games": bot_status['active_games'],
+        "memory_usage": bot_status['total_users'],
+        "total_games": bot_status['total_games']
+    }) + b'\n\n'
+    _stats_feed['version'] += 1
+    _stats_feed['changed'].set()
+    _stats_feed['changed'] = asyncio.Event()
+
+async def stats_loop():
+    """مهمة خلفية لتحديث الإحصائيات دورياً بدلاً من حسابها في كل طلب"""
+    while True:
+        update_bot_stats()
+        await asyncio.sleep(STATS_INTERVAL)
+
+# الملفات الثابتة لصفحة المراقبة (CSS/JS) تُخزن في المتصفح وتُطلب مرة واحدة
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_CACHE_CONTROL: Final = 'public, max-age=31536000, immutable'
+
+# روابط الملفات الثابتة مع رقم الإصدار (تُحدد عند بدء الخادم)
+_static_urls = {'css_url': '/static/status.css', 'js_url': '/static/status.js'}
+
+# صفحة المراقبة مقسمة إلى بادئة وخاتمة مُرمزتين مسبقاً وجزء أوسط صغير يُعاد تنسيقه فقط
+# البادئة تتضمن روابط الملفات الثابتة وتُعاد بناؤها عند بدء الخادم
+STATUS_PAGE_HEAD = string.Template("""
+<!DOCTYPE html>
+<html dir="rtl">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>🤖 حالة بوت XO</title>
+    <link rel="stylesheet" href="$css_url">
+    <script defer src="$js_url"></script>
+</head>
+<body>
+    <div class="container">
+        <h1>🤖 بوت XO - لوحة المراقبة</h1>
+
+        <div class="status-card">
+            <h2>🟢 حالة البوت <span class="status-indicator"></span></h2>
+            <div class="metric">📊 الحالة: <strong>يعمل بشكل طبيعي</strong></div>
+""")
+STATUS_PAGE_METRICS = string.Template("""            <div class="metric">⏰ آخر نبضة: <strong id="last_heartbeat">$last_heartbeat</strong></div>
+            <div class="metric">🕐 وقت التشغيل: <strong id="uptime">$uptime</strong></div>
+        </div>
+
+        <div class="status-card">
+            <h2>📈 الإحصائيات</h2>
+            <div class="metric">🎮 الألعاب النشطة: <strong id="active_games">$active_games</strong></div>
+            <div class="metric">💾 استخدام الذاكرة: <strong><span id="total_users">$total_users</span> مستخدم مُخزن</strong></div>
+            <div class="metric">🔄 إجمالي الألعاب: <strong><span id="total_games">$total_games</span> لعبة مُسجلة</strong></div>
+        </div>
+
+""")
+# قيم معلومات النظام ثابتة طوال التشغيل، لذا تُنسق الخاتمة مرة واحدة
+STATUS_PAGE_SUFFIX: Final = string.Template("""        <div class="status-card">
+            <h2>ℹ️ معلومات النظام</h2>
+            <div class="metric">🌐 المنفذ: <strong>$port</strong></div>
+            <div class="metric">📡 نوع الاتصال: <strong>$connection_mode</strong></div>
+            <div class="metric">🔐 الحماية: <strong>مُفعلة</strong></div>
+            <div class="metric">🔄 التحديث التلقائي: <strong id="refresh_interval">كل 30 ثانية</strong></div>
+        </div>
+
+        <div style="text-align: center; margin-top: 20px;">
+            <button class="refresh-btn" onclick="refreshPage()">🔄 تحديث يدوي</button>
+            <button class="refresh-btn" onclick="window.open('/health', '_blank')">📊 فحص الصحة</button>
+        </div>
+    </div>
+</body>
+</html>
+""").substitute(
+    port=PORT,
+    connection_mode='Webhook' if PUBLIC_URL else 'Polling'
+).encode('utf-8')
+_status_page_parts = {'prefix': STATUS_PAGE_HEAD.substitute(_static_urls).encode('utf-8')}
+STATUS_PAGE_TTL = 5  # مدة إعادة استخدام الصفحة المعروضة بالثواني
+
+# آخر صفحة مراقبة معروضة وآخر استجابة فحص صحة مُرمزة
+_status_page_cache = {'at': 0.0, 'body': b'', 'etag': '', 'gzip': b'', 'gzip_etag': ''}
+_health_cache = {'at': 0.0, 'body': b''}
+
+# رد ping ثابت مُرمز مسبقاً
+_PONG_BYTES: Final = "pong! 🏓".encode('utf-8')
+
+def render_status_page() -> bytes:
+    """عرض صفحة المراقبة مع إعادة استخدامها لمدة قصيرة"""
+    now = time.monotonic()
+    if _status_page_cache['body'] and now - _status_page_cache['at'] < STATUS_PAGE_TTL:
+        return _status_page_cache['body']
+
+    metrics = STATUS_PAGE_METRICS.substitute(
+        last_heartbeat=bot_status['last_heartbeat'],
+        uptime=bot_status['uptime'],
+        active_games=bot_status['active_games'],
+        total_users=bot_status['total_users'],
+        total_games=bot_status['total_games']
+    )
+    body = _status_page_parts['prefix'] + metrics.encode('utf-8') + STATUS_PAGE_SUFFIX
+
+    _status_page_cache['at'] = now
+    _status_page_cache['body'] = body
+    digest = hashlib.blake2b(body, digest_size=8).hexdigest()
+    _status_page_cache['etag'] = f'"{digest}"'
+    # نسخة مضغوطة تُحسب مرة واحدة لكل عرض وتُقدم لكل من يدعم gzip
+    _status_page_cache['gzip'] = gzip.compress(body, compresslevel=9)
+    _status_page_cache['gzip_etag'] = f'"{digest}-gzip"'
+    return body
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """هل يقبل العميل gzip حسب ترويسة Accept-Encoding (مع احترام q=0)"""
+    # هيكل: {الترميز: قيمة q}
+    weights: Dict[str, float] = {}
+    for token in accept_encoding.lower().split(','):
+        coding, _, params = token.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip()] = q
+    return weights.get('gzip', weights.get('*', 0.0)) > 0
 
 async def web_handler(request):
     """معالج طلبات الويب للحفاظ على نشاط البوت مع معلومات مفصلة"""
-    update_bot_stats()
-
-    status_html = f"""
-    <!DOCTYPE html>
-    <html dir="rtl">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>🤖 حالة بوت XO</title>
-        <style>
-            body {{
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                margin: 0;
-                padding: 20px;
-                min-height: 100vh;
-            }}
-            .container {{
-                max-width: 800px;
-                margin: 0 auto;
-                background: rgba(255, 255, 255, 0.1);
-                border-radius: 15px;
-                padding: 30px;
-                backdrop-filter: blur(10px);
-                box-shadow: 0 8px 32px rgba(0,0,0,0.1);
-            }}
-            .status-card {{
-                background: rgba(255, 255, 255, 0.2);
-                border-radius: 10px;
-                padding: 20px;
-                margin: 15px 0;
-                border: 1px solid rgba(255, 255, 255, 0.2);
-            }}
-            .status-indicator {{
-                display: inline-block;
-                width: 12px;
-                height: 12px;
-                background: #00ff00;
-                border-radius: 50%;
-                animation: pulse 2s infinite;
-                margin-left: 10px;
-            }}
-            @keyframes pulse {{
-                0% {{ opacity: 1; }}
-                50% {{ opacity: 0.5; }}
-                100% {{ opacity: 1; }}
-            }}
-            h1 {{ text-align: center; margin-bottom: 30px; }}
-            h2 {{ color: #ffd700; }}
-            .metric {{ margin: 10px 0; font-size: 16px; }}
-            .refresh-btn {{
-                background: #4CAF50;
-                color: white;
-                border: none;
-                padding: 10px 20px;
-                border-radius: 5px;
-                cursor: pointer;
-                font-size: 16px;
-                margin: 10px 5px;
-            }}
-            .refresh-btn:hover {{ background: #45a049; }}
-        </style>
-        <script>
-            function refreshPage() {{ location.reload(); }}
-            setInterval(refreshPage, 30000); // تحديث كل 30 ثانية
-        </script>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🤖 بوت XO - لوحة المراقبة</h1>
-
-            <div class="status-card">
-                <h2>🟢 حالة البوت <span class="status-indicator"></span></h2>
-                <div class="metric">📊 الحالة: <strong>يعمل بشكل طبيعي</strong></div>
-                <div class="metric">⏰ آخر نبضة: <strong>{bot_status['last_heartbeat']}</strong></div>
-                <div class="metric">🕐 وقت التشغيل: <strong>{bot_status['uptime']}</strong></div>
-            </div>
-
-            <div class="status-card">
-                <h2>📈 الإحصائيات</h2>
-                <div class="metric">🎮 الألعاب النشطة: <strong>{bot_status['active_games']}</strong></div>
-                <div class="metric">💾 استخدام الذاكرة: <strong>{len(games)} مستخدم مُخزن</strong></div>
-                <div class="metric">🔄 إجمالي الألعاب: <strong>{sum(len(user_games) for user_games in games.values())} لعبة مُسجلة</strong></div>
-            </div>
-
-            <div class="status-card">
-                <h2>ℹ️ معلومات النظام</h2>
-                <div class="metric">🌐 المنفذ: <strong>{PORT}</strong></div>
-                <div class="metric">📡 نوع الاتصال: <strong>Webhook + Polling</strong></div>
-                <div class="metric">🔐 الحماية: <strong>مُفعلة</strong></div>
-                <div class="metric">🔄 التحديث التلقائي: <strong>كل 30 ثانية</strong></div>
-            </div>
-
-            <div style="text-align: center; margin-top: 20px;">
-                <button class="refresh-btn" onclick="refreshPage()">🔄 تحديث يدوي</button>
-                <button class="refresh-btn" onclick="window.open('/health', '_blank')">📊 فحص الصحة</button>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    return web.Response(text=status_html, content_type='text/html')
+    body = render_status_page()
+    use_gzip = accepts_gzip(request.headers.get('Accept-Encoding', ''))
+    headers = {
+        'ETag': _status_page_cache['gzip_etag' if use_gzip else 'etag'],
+        'Cache-Control': f'public, max-age={STATUS_PAGE_TTL}',
+        'Vary': 'Accept-Encoding'
+    }
+    # إعادة التحقق بدون إرسال الصفحة إذا لم تتغير
+    if request.headers.get('If-None-Match') == headers['ETag']:
+        return web.Response(status=304, headers=headers)
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        body = _status_page_cache['gzip']
+    return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
+
+STATUS_REDIRECT_CACHE_CONTROL: Final = 'public, max-age=86400'
+
+async def status_redirect_handler(request):
+    """تحويل /status إلى / حتى تُخزن الصفحة ووسم ETag تحت رابط واحد"""
+    location = request.rel_url.with_path('/').with_query(request.rel_url.query)
+    raise web.HTTPMovedPermanently(location, headers={'Cache-Control': STATUS_REDIRECT_CACHE_CONTROL})
 
 async def health_check_handler(request):
     """معالج فحص صحة البوت"""
-    update_bot_stats()
+    now = time.monotonic()
+    if _health_cache['body'] and now - _health_cache['at'] < STATUS_PAGE_TTL:
+        return web.Response(body=_health_cache['body'], content_type='application/json')
 
     health_data = {
         "status": "healthy",
         "timestamp": bot_status['last_heartbeat'],
         "uptime": bot_status['uptime'],
         "active_games": bot_status['active_games'],
-        "memory_usage": len(games),
+        "memory_usage": bot_status['total_users'],
+        "total_games": bot_status['total_games'],
         "bot_responsive": True
     }
 
-    return web.json_response(health_data)
+    _health_cache['at'] = now
+    _health_cache['body'] = orjson.dumps(health_data)
+    return web.Response(body=_health_cache['body'], content_type='application/json')
+
+async def events_handler(request):
+    """بث الإحصائيات عبر Server-Sent Events عند تغيرها فقط"""
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+    sent_version = 0
+    try:
+        while not _stats_feed['closed']:
+            # إرسال أحدث لقطة كلما تقدم الإصدار، حتى لو تغير أثناء الكتابة السابقة
+            if _stats_feed['version'] != sent_version:
+                sent_version = _stats_feed['version']
+                await response.write(_stats_feed['body'])
+                continue
+            try:
+                await asyncio.wait_for(_stats_feed['changed'].wait(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b': keepalive\n\n')
+    except ConnectionResetError:
+        pass
+    return response
+
+async def close_event_streams(app):
+    """إنهاء اتصالات /events المفتوحة حتى لا تؤخر إيقاف الخادم"""
+    _stats_feed['closed'] = True
+    _stats_feed['changed'].set()
 
 async def ping_handler(request):
     """معالج ping بسيط"""
-    return web.Response(text="pong! 🏓")
+    return web.Response(body=_PONG_BYTES, content_type='text/plain', charset='utf-8')
 
 # === معالج الأخطاء العام ===
 
 @dp.error()
-async def error_handler(event, exception):
+async def error_handler(event: ErrorEvent):
     """معالج عام للأخطاء"""
-    logger.error(f"خطأ غير متوقع: {exception}")
-    logger.error(traceback.format_exc())
+    exception = event.exception
+    # تجاهل أخطاء Telegram الروتينية بدون تسجيل
+    if is_not_modified_error(exception):
+        return True
+    log_error("خطأ غير متوقع", exception)
     return True
 
 # === الدالة الرئيسية ===
 
+# ترويسات مشتركة تُضاف لكل استجابة مرة واحدة بدلاً من تكرارها في كل معالج
+COMMON_RESPONSE_HEADERS: Final = {'X-Content-Type-Options': 'nosniff'}
+# سياسة التخزين لمن لا يحددها بنفسه (فحص الصحة و ping يجب أن يكونا حديثين دائماً)
+DEFAULT_CACHE_CONTROL: Final = 'no-store'
+
+async def add_response_headers(request, response):
+    """توحيد ترويسات الاستجابة وسياسة التخزين لكل الطلبات"""
+    response.headers.update(COMMON_RESPONSE_HEADERS)
+    # التخزين الدائم للملفات الموجودة فقط؛ أخطاء مثل 404 تبقى بلا تخزين
+    if request.path.startswith('/static/') and response.status < 400:
+        response.headers['Cache-Control'] = STATIC_CACHE_CONTROL
+    else:
+        response.headers.setdefault('Cache-Control', DEFAULT_CACHE_CONTROL)
+
 async def start_web_server():
     """بدء تشغيل خادم الويب"""
     app = web.Application()
     app.router.add_get('/', web_handler)
     app.router.add_get('/health', health_check_handler)
     app.router.add_get('/ping', ping_handler)
-    app.router.add_get('/status', web_handler)
+    app.router.add_get('/events', events_handler)
+    app.router.add_get('/status', status_redirect_handler)
+
+    # الملفات الثابتة مع رقم إصدار في الرابط حتى يمكن تخزينها بلا انتهاء
+    static = app.router.add_static('/static', STATIC_DIR, name='static', append_version=True)
+    for key, filename in (('css_url', 'status.css'), ('js_url', 'status.js')):
+        _static_urls[key] = str(static.url_for(filename=filename, append_version=True))
+    _status_page_parts['prefix'] = STATUS_PAGE_HEAD.substitute(_static_urls).encode('utf-8')
+    app.on_response_prepare.append(add_response_headers)
+    app.on_shutdown.append(close_event_streams)
+
+    # استقبال تحديثات Telegram عبر نفس الخادم عند تفعيل Webhook
+    if PUBLIC_URL:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
     
-    runner = web.AppRunner(app)
+    # بدون سجل وصول لكل طلب (طلبات ping و health متكررة جداً)
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
     
     bot_status['start_time'] = time.time()
-    logger.info(f"🌐 خادم الويب يعمل على المنفذ {PORT}")
+    logger.info("🌐 خادم الويب يعمل على المنفذ %s", PORT)
     return runner
 
+async def receive_updates():
+    """استقبال التحديثات عبر Webhook أو Polling حتى إيقاف البوت"""
+    if PUBLIC_URL:
+        # استقبال التحديثات عبر Webhook بدلاً من الاستطلاع المستمر
+        await bot.set_webhook(
+            url=PUBLIC_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES
+        )
+        logger.info("🔗 تم تفعيل Webhook")
+
+        # الانتظار حتى SIGTERM (إعادة النشر) حتى تُنفذ خطوات الإغلاق في main()
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows: الإيقاف عبر Ctrl+C فقط
+        try:
+            await stop_event.wait()
+            logger.info("🛑 تم استلام SIGTERM، جارٍ الإيقاف...")
+        finally:
+            try:
+                loop.remove_signal_handler(signal.SIGTERM)
+            except NotImplementedError:
+                pass
+    else:
+        # بدء استقبال التحديثات (كل تحديث في مهمة مستقلة)
+        await bot.delete_webhook()
+        await dp.start_polling(bot, handle_as_tasks=True, allowed_updates=ALLOWED_UPDATES)
+
 async def main():
     """الدالة الرئيسية لتشغيل البوت"""
     logger.info("🚀 بدء تشغيل البوت...")
     
     # بدء خادم الويب
     web_runner = await start_web_server()
-    
-    # بدء استقبال التحديثات
-    await dp.start_polling(bot)
-    
-    # تنظيف بعد التوقف
-    await bot.session.close()
-    await web_runner.cleanup()
-    logger.info("🔚 تم إيقاف البوت")
+
+    try:
+        # المهام الخلفية ضمن مجموعة واحدة: فشل أي منها يوقف البوت بدلاً من توقفها بصمت
+        async with asyncio.TaskGroup() as tg:
+            background_tasks = (
+                tg.create_task(outbound_queue.run()),
+                tg.create_task(games_gc_loop()),
+                tg.create_task(stats_loop())
+            )
+            try:
+                await receive_updates()
+            finally:
+                for task in background_tasks:
+                    task.cancel()
+    finally:
+        # تنظيف بعد التوقف (بعد إرسال التعديلات المتبقية في الطابور)
+        await outbound_queue.flush()
+        await bot.session.close()
+        await web_runner.cleanup()
+        logger.info("🔚 تم إيقاف البوت")
 
 if __name__ == "__main__":
+    # استخدام uvloop كحلقة أحداث أسرع (غير متاح على ويندوز)، مع الرجوع للحلقة الافتراضية عند غيابه
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         logger.info("⏹️ تم إيقاف البوت بواسطة المستخدم")
-    except Exception as e:
-        logger.error(f"💥 خطأ في تشغيل البوت: {e}")
-        logger.error(traceback.format_exc())
+    except Exception:
+        logger.exception("💥 خطأ في تشغيل البوت")
@@ -0,0 +1,74 @@
+// تحديث القيم في مكانها: بث مباشر من /events، مع الرجوع إلى استطلاع /health عند عدم الدعم
+// فاصل الاستطلاع قابل للضبط عبر ?refresh=<ثوانٍ> ضمن [2, 300]، الافتراضي 30 ثانية
+const REFRESH_SECONDS = Math.max(2, Math.min(300,
+    parseInt(new URLSearchParams(location.search).get('refresh'), 10) || 30));
+
+// هيكل: {معرف العنصر: مفتاح /health}
+const FIELDS = {
+    last_heartbeat: 'timestamp',
+    uptime: 'uptime',
+    active_games: 'active_games',
+    total_users: 'memory_usage',
+    total_games: 'total_games'
+};
+
+// البث المباشر عند دعمه، وإلا الاستطلاع الدوري
+const USE_STREAM = Boolean(window.EventSource);
+
+let refreshTimer = null;
+let eventSource = null;
+
+function updateFields(data) {
+    for (const [id, key] of Object.entries(FIELDS)) {
+        const element = document.getElementById(id);
+        if (element && key in data) element.textContent = data[key];
+    }
+}
+
+// تذبذب ±10% حتى لا تتزامن طلبات التبويبات المفتوحة معاً
+function nextDelay() {
+    return REFRESH_SECONDS * 1000 * (1 + 0.1 * (Math.random() * 2 - 1));
+}
+
+async function refreshPage() {
+    clearTimeout(refreshTimer);
+    // لا طلبات أثناء إخفاء التبويب؛ يُستأنف التحديث عند ظهوره
+    if (document.hidden) return;
+
+    try {
+        const response = await fetch('/health');
+        updateFields(await response.json());
+    } catch (error) {
+        // تجاهل أخطاء الشبكة المؤقتة والمحاولة في الدورة التالية
+    } finally {
+        // جدولة الطلب التالي بعد اكتمال الحالي حتى لا تتداخل الطلبات
+        // (فقط في وضع الاستطلاع؛ مع البث المباشر يكون التحديث اليدوي طلباً واحداً)
+        if (!USE_STREAM) refreshTimer = setTimeout(refreshPage, nextDelay());
+    }
+}
+
+// اتصال واحد مفتوح يستقبل القيم عند تغيرها فقط (يعيد المتصفح الاتصال تلقائياً)
+function openStream() {
+    if (eventSource || document.hidden) return;
+    eventSource = new EventSource('/events');
+    eventSource.onmessage = (event) => updateFields(JSON.parse(event.data));
+}
+
+function closeStream() {
+    if (eventSource) eventSource.close();
+    eventSource = null;
+}
+
+if (USE_STREAM) {
+    document.addEventListener('visibilitychange', () => {
+        if (document.hidden) closeStream(); else openStream();
+    });
+    document.getElementById('refresh_interval').textContent = 'مباشر عند التغيير';
+    openStream();
+} else {
+    document.addEventListener('visibilitychange', () => {
+        if (!document.hidden) refreshPage();
+    });
+    document.getElementById('refresh_interval').textContent = `كل ${REFRESH_SECONDS} ثانية`;
+    refreshTimer = setTimeout(refreshPage, nextDelay());
+}